@@ -10,8 +10,7 @@ from pathlib import Path
 # Add src directory to path
 sys.path.insert(0, str(Path(__file__).parent / "src"))
 
-from tuya_mcp_server import main
-import asyncio
+from tuya_mcp_server import cli_main
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    cli_main()
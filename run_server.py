@@ -11,8 +11,7 @@ from pathlib import Path
 src_path = Path(__file__).parent / "src"
 sys.path.insert(0, str(src_path))
 
-from tuya_mcp_server import main
-import asyncio
+from tuya_mcp_server import cli_main
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    cli_main()
@@ -7,14 +7,17 @@ Supports lights, outlets, switches, and other compatible Tuya devices.
 """
 
 import asyncio
-import json
 import logging
+import math
 import os
 import sys
-from typing import Any, Dict, List, Optional, Union
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Any, Dict, List, Optional, Tuple, Union
 from pathlib import Path
-import colorsys
 
+import orjson
 import tinytuya
 from mcp.server.models import InitializationOptions
 from mcp.server import NotificationOptions, Server
@@ -26,123 +29,347 @@ from mcp.types import (
     Tool,
     TextContent,
 )
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, computed_field, field_validator
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Use absolute path to ensure we find devices.json regardless of working directory
+_CONFIG_FILE = Path(__file__).resolve().parent.parent / "devices.json"  # Go up from src/ to project root
+
+# Two-digit hex for every byte value, used to build color strings
+_HEX2 = tuple(f"{i:02x}" for i in range(256))
+
+# Layout entry a command needs beyond power; re-detected if still unknown
+_COMMAND_LAYOUT_KEYS = {"set_brightness": "brightness", "set_color": "color", "set_magenta": "color"}
+
+# Upper bounds (seconds) on how long list_devices waits for device statuses,
+# a single device command runs, and a control_multiple_devices batch runs
+_LIST_DEVICES_TIMEOUT = 30
+_COMMAND_TIMEOUT = 5
+_BATCH_TIMEOUT = 15
+
+# tinytuya socket timeout and retries; one call can take about
+# _SOCKET_TIMEOUT * (_SOCKET_RETRY_LIMIT + 1), which must stay under _COMMAND_TIMEOUT
+# so a timed-out command doesn't leave an executor thread blocked long after
+_SOCKET_TIMEOUT = 2
+_SOCKET_RETRY_LIMIT = 1
+
+# Allowed discovery scan duration in seconds
+_MIN_SCAN_TIMEOUT = 1
+_MAX_SCAN_TIMEOUT = 30
+
+# Candidate DPS numbers in priority order
+_POWER_KEYS = ('1', '20')  # Power is usually 1 or 20
+_BRIGHT_KEYS = ('3', '22', '23')  # Common brightness DPS numbers
+_COLOR_KEYS = ('24', '5')  # 24 for Merkury/Genii bulbs, 5 for workbench lights
+
 class DeviceConfig(BaseModel):
     """Configuration for a Tuya device"""
+    # Reject unknown fields, including the derived version_f
+    model_config = ConfigDict(extra="forbid")
+    
     device_id: str
     name: str
     ip: str
     local_key: str
     version: str = "3.3"
     device_type: str = "generic"  # outlet, bulb, switch, etc.
+    
+    @field_validator("version", mode="before")
+    @classmethod
+    def _check_version(cls, v: Any) -> str:
+        """Accept numeric versions, default blank ones, reject unparseable ones"""
+        if v is None or v == "":
+            return "3.3"
+        v = str(v)
+        float(v)  # ValueError becomes a ValidationError
+        return v
+        
+    @computed_field
+    @property
+    def version_f(self) -> float:
+        """Protocol version as a float for tinytuya constructors"""
+        return float(self.version)
+
+class CommandError(Exception):
+    """A device command was invalid or unsupported by the device"""
+
+class RGBValue(BaseModel):
+    """RGB color value for the set_color command"""
+    r: int = Field(ge=0, le=255)
+    g: int = Field(ge=0, le=255)
+    b: int = Field(ge=0, le=255)
+
+class DPSValue(BaseModel):
+    """Raw data point write for the set_dps command"""
+    dp: int
+    value: Any
 
 class TuyaDeviceManager:
     """Manages Tuya device connections and operations"""
     
     def __init__(self):
-        self.devices: Dict[str, DeviceConfig] = {}
+        # Device configuration stored as parallel lists (one entry per device),
+        # with id_index mapping a device ID to its position
+        self.ids: List[str] = []
+        self.names: List[str] = []
+        self.ips: List[str] = []
+        self.keys: List[str] = []
+        self.versions: List[float] = []
+        self.types: List[str] = []
+        self.id_index: Dict[str, int] = {}
         self.device_connections: Dict[str, tinytuya.Device] = {}
-        # Use absolute path to ensure we find devices.json regardless of working directory
-        project_dir = Path(__file__).parent.parent  # Go up from src/ to project root
-        self.config_file = project_dir / "devices.json"
+        self.connection_last_used: Dict[str, float] = {}
+        # Per-device DPS numbers for power/brightness/color, detected on first contact
+        self.dps_layout: Dict[str, Dict[str, Optional[str]]] = {}
+        # Last known DPS values, refreshed on status() and updated by our own writes
+        self.last_dps: Dict[str, Dict[str, Any]] = {}
+        # Cap concurrent device commands so bulk operations don't flood the LAN.
+        # Created lazily so it binds to the running loop, not the one at import
+        self._sem: Optional[asyncio.Semaphore] = None
+        # tinytuya does blocking socket I/O; run it off the event loop
+        self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="tuya")
+        # One in-flight request per device, since a persistent socket can't be shared
+        self._device_locks: Dict[str, asyncio.Lock] = {}
+        self._warm_task: Optional[asyncio.Task] = None
+        # Command name -> handler(device, layout, dps, value) returning (result, DPS changes)
+        self._handlers = {
+            "turn_on": self._h_turn_on,
+            "turn_off": self._h_turn_off,
+            "toggle": self._h_toggle,
+            "set_brightness": self._h_set_brightness,
+            "set_color": self._h_set_color,
+            "set_magenta": self._h_set_magenta,
+            "set_dps": self._h_set_dps,
+        }
+        self.config_file = _CONFIG_FILE
+        self._loaded = False
         
-    def rgb_to_hsv_hex(self, r: int, g: int, b: int) -> str:
-        """Convert RGB (0-255) to HSV hex format for Tuya bulbs"""
-        # Convert to 0-1 range
-        r_norm, g_norm, b_norm = r/255.0, g/255.0, b/255.0
+    async def _run_blocking(self, func, *args, **kwargs) -> Any:
+        """Run a blocking tinytuya call in the device I/O thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
         
-        # Convert to HSV
-        h, s, v = colorsys.rgb_to_hsv(r_norm, g_norm, b_norm)
-        
-        # Convert to Tuya format:
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def rgb_to_hsv_hex(r: int, g: int, b: int) -> str:
+        """Convert RGB (0-255) to HSV hex format for Tuya bulbs"""
+        # Integer HSV, cached since scenes reuse a small palette.
+        # Tuya format (all scaled to 0-1000):
         # Hue: 0-360 -> 0-1000 (scaled)
         # Saturation: 0-1 -> 0-1000 
         # Value: 0-1 -> 0-1000
-        h_tuya = int(h * 360 * 1000 / 360)  # 0-1000
-        s_tuya = int(s * 1000)              # 0-1000  
-        v_tuya = int(v * 1000)              # 0-1000
-        
+        mx = max(r, g, b)
+        mn = min(r, g, b)
+        d = mx - mn
+        v_tuya = mx * 1000 // 255
+        if d == 0:
+            h_tuya = s_tuya = 0
+        else:
+            s_tuya = d * 1000 // mx
+            if mx == r:
+                h_tuya = (g - b) * 1000 // (6 * d) % 1000
+            elif mx == g:
+                h_tuya = (2 * d + b - r) * 1000 // (6 * d)
+            else:
+                h_tuya = (4 * d + r - g) * 1000 // (6 * d)
+                
         # Format as 6-byte hex: HHHHSSSSBBBB
         return f"{h_tuya:04x}{s_tuya:04x}{v_tuya:04x}"
         
-    def rgb_to_workbench_hex(self, r: int, g: int, b: int) -> str:
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def rgb_to_workbench_hex(r: int, g: int, b: int) -> str:
         """Convert RGB to workbench light hex format"""
         # For workbench lights, try simple RGB hex format
-        return f"ff{r:02x}{g:02x}{b:02x}00ffff"
+        return "ff" + _HEX2[r] + _HEX2[g] + _HEX2[b] + "00ffff"
+        
+    async def load_devices(self, warm: bool = False) -> None:
+        """Load device configurations from devices.json
         
-    async def load_devices(self) -> None:
-        """Load device configurations from devices.json"""
+        With warm=True, connections to every device are opened in the background.
+        That saves the handshake on the first command, but holds a socket to each
+        device, and many Tuya devices accept only one connection at a time.
+        """
+        if self._loaded:
+            return
+            
         try:
             if self.config_file.exists():
-                with open(self.config_file, 'r') as f:
-                    data = json.load(f)
+                raw = await self._run_blocking(self.config_file.read_bytes)
+                data = orjson.loads(raw)
                     
-                # Handle TinyTuya wizard format
+                # Handle TinyTuya wizard format; skip bad entries rather than the whole file
                 for device_data in data:
-                    device_config = DeviceConfig(
-                        device_id=device_data["id"],
-                        name=device_data.get("name", device_data["id"]),
-                        ip=device_data["ip"],
-                        local_key=device_data["key"],
-                        version=str(device_data.get("version", "3.3"))
-                    )
-                    self.devices[device_config.device_id] = device_config
+                    try:
+                        device_config = DeviceConfig(
+                            device_id=device_data["id"],
+                            name=device_data.get("name", device_data["id"]),
+                            ip=device_data["ip"],
+                            local_key=device_data["key"],
+                            version=device_data.get("version", "3.3")
+                        )
+                    except (KeyError, TypeError, AttributeError, ValidationError) as e:
+                        logger.warning(f"Skipping invalid device entry {device_data!r:.80}: {e}")
+                        continue
+                    self._add_device(device_config)
                     
-                logger.info(f"Loaded {len(self.devices)} devices from configuration")
+                logger.info(f"Loaded {len(self.ids)} devices from configuration")
+                self._loaded = True
+                
+                if warm:
+                    # Open device connections in the background so the first command doesn't pay for it
+                    self._warm_task = asyncio.create_task(self._warm_connections())
             else:
                 logger.warning("No devices.json found. Run 'python -m tinytuya wizard' to set up devices.")
                 
         except Exception as e:
             logger.error(f"Error loading device configuration: {e}")
             
+    def _add_device(self, config: DeviceConfig) -> None:
+        """Store a validated device config, replacing any entry with the same ID"""
+        i = self.id_index.get(config.device_id)
+        if i is None:
+            self.id_index[config.device_id] = len(self.ids)
+            self.ids.append(config.device_id)
+            self.names.append(config.name)
+            self.ips.append(config.ip)
+            self.keys.append(config.local_key)
+            self.versions.append(config.version_f)
+            self.types.append(config.device_type)
+        else:
+            self.names[i] = config.name
+            self.ips[i] = config.ip
+            self.keys[i] = config.local_key
+            self.versions[i] = config.version_f
+            self.types[i] = config.device_type
+            
     def get_device_connection(self, device_id: str) -> Optional[tinytuya.Device]:
         """Get or create a device connection"""
-        if device_id not in self.devices:
+        i = self.id_index.get(device_id)
+        if i is None:
             return None
             
         if device_id not in self.device_connections:
-            config = self.devices[device_id]
+            device_type = self.types[i]
             
             # Create appropriate device type
-            if config.device_type == "bulb":
+            if device_type == "bulb":
                 device = tinytuya.BulbDevice(
-                    config.device_id,
-                    config.ip,
-                    config.local_key,
-                    version=float(config.version)
+                    device_id,
+                    self.ips[i],
+                    self.keys[i],
+                    version=self.versions[i]
                 )
-            elif config.device_type == "outlet":
+            elif device_type == "outlet":
                 device = tinytuya.OutletDevice(
-                    config.device_id,
-                    config.ip,
-                    config.local_key,
-                    version=float(config.version)
+                    device_id,
+                    self.ips[i],
+                    self.keys[i],
+                    version=self.versions[i]
                 )
             else:
                 # Generic device for switches and other devices
                 device = tinytuya.Device(
-                    config.device_id,
-                    config.ip,
-                    config.local_key,
-                    version=float(config.version)
+                    device_id,
+                    self.ips[i],
+                    self.keys[i],
+                    version=self.versions[i]
                 )
             
-            # Set connection timeout
-            device.set_socketTimeout(10)
+            # Set connection timeout and keep the socket open between commands
+            device.set_socketTimeout(_SOCKET_TIMEOUT)
+            device.set_socketPersistent(True)
+            device.set_socketRetryLimit(_SOCKET_RETRY_LIMIT)
             self.device_connections[device_id] = device
             
+        self.connection_last_used[device_id] = time.monotonic()
         return self.device_connections[device_id]
         
-    async def discover_devices(self) -> List[Dict[str, Any]]:
+    def _command_slots(self) -> asyncio.Semaphore:
+        """Get the semaphore limiting concurrent device commands"""
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(8)
+        return self._sem
+        
+    def _device_lock(self, device_id: str) -> asyncio.Lock:
+        """Get the lock serializing requests to one device"""
+        lock = self._device_locks.get(device_id)
+        if lock is None:
+            lock = self._device_locks[device_id] = asyncio.Lock()
+        return lock
+        
+    async def _warm_connection(self, device_id: str) -> None:
+        """Open a device's socket and cache its DPS layout"""
+        async with self._device_lock(device_id):
+            # Fetch under the lock so we don't reuse a connection closed while waiting
+            device = self.get_device_connection(device_id)
+            try:
+                status = await self._run_blocking(device.status)
+            except asyncio.CancelledError:
+                self._discard_device_state(device_id)
+                raise
+        if status and 'dps' in status:
+            self._record_status(device_id, status['dps'])
+            
+    async def _warm_connections(self) -> None:
+        """Connect to all configured devices in parallel"""
+        results = await asyncio.gather(
+            *(self._warm_connection(device_id) for device_id in self.ids),
+            return_exceptions=True
+        )
+        failed = sum(1 for r in results if isinstance(r, Exception))
+        logger.info(f"Warmed up {len(results) - failed}/{len(results)} device connections")
+        
+    def _close_connection(self, device_id: str) -> None:
+        """Close and forget a cached device connection"""
+        device = self.device_connections.pop(device_id, None)
+        self.connection_last_used.pop(device_id, None)
+        if device:
+            try:
+                device.close()
+            except Exception as e:
+                logger.debug(f"Error closing connection to {device_id}: {e}")
+                
+    def _discard_device_state(self, device_id: str) -> None:
+        """Forget a device's socket and cached DPS after an interrupted request"""
+        # A cancelled request may leave its executor thread still using the socket,
+        # so the next request must open a fresh connection
+        self._close_connection(device_id)
+        self.last_dps.pop(device_id, None)
+        
+    async def reap_idle_connections(self, idle_timeout: float = 30, interval: float = 10) -> None:
+        """Periodically close persistent sockets that have been idle too long"""
+        while True:
+            await asyncio.sleep(interval)
+            cutoff = time.monotonic() - idle_timeout
+            for device_id, last_used in list(self.connection_last_used.items()):
+                if last_used >= cutoff:
+                    continue
+                # Wait for any in-flight request so we never close a socket a worker is using
+                async with self._device_lock(device_id):
+                    if self.connection_last_used.get(device_id, cutoff) < cutoff:
+                        logger.debug(f"Closing idle connection to {device_id}")
+                        self._close_connection(device_id)
+                    
+    async def close(self) -> None:
+        """Close all device connections and stop the I/O thread pool"""
+        if self._warm_task:
+            self._warm_task.cancel()
+        for device_id in list(self.device_connections):
+            self._close_connection(device_id)
+        self._executor.shutdown(wait=False)
+        
+    async def discover_devices(self, timeout: float = 6.0) -> List[Dict[str, Any]]:
         """Discover devices on the network"""
+        # Keep a long scan from tying up an executor thread
+        timeout = min(max(timeout, _MIN_SCAN_TIMEOUT), _MAX_SCAN_TIMEOUT)
         try:
-            logger.info("Scanning network for Tuya devices...")
-            devices = tinytuya.deviceScan(False, 20)  # No verbose, 20 second timeout
+            logger.info(f"Scanning network for Tuya devices ({timeout}s)...")
+            # Devices broadcast every 3-6 seconds, so a short scan catches most of them
+            devices = await self._run_blocking(tinytuya.deviceScan, False, int(timeout))
             
             discovered = []
             for device_id, device_info in devices.items():
@@ -158,136 +385,232 @@ class TuyaDeviceManager:
             logger.error(f"Error during device discovery: {e}")
             return []
             
+    @staticmethod
+    def _detect_dps_layout(dps: Dict[str, Any]) -> Dict[str, Optional[str]]:
+        """Work out which DPS numbers control power, brightness and color"""
+        power_dps = next((k for k in _POWER_KEYS if k in dps), None)
+        brightness_dps = next((k for k in _BRIGHT_KEYS if k in dps), None)
+        color_dps = next((k for k in _COLOR_KEYS if k in dps), None)
+        return {"power": power_dps, "brightness": brightness_dps, "color": color_dps}
+        
+    def _record_status(self, device_id: str, dps: Dict[str, Any]) -> None:
+        """Cache a fresh DPS snapshot and the layout derived from it"""
+        self.last_dps[device_id] = dict(dps)
+        layout = self.dps_layout.get(device_id)
+        if layout is not None and None not in layout.values():
+            return
+            
+        # Fill in anything an earlier (possibly partial) reply didn't include
+        detected = self._detect_dps_layout(dps)
+        if layout is not None:
+            detected = {key: layout[key] or detected[key] for key in detected}
+        # A reply without a power DPS is too incomplete to cache
+        if detected["power"] is not None:
+            self.dps_layout[device_id] = detected
+            
     async def get_device_status(self, device_id: str) -> Dict[str, Any]:
         """Get current status of a device"""
-        device = self.get_device_connection(device_id)
-        if not device:
+        if device_id not in self.id_index:
             return {"error": f"Device {device_id} not found"}
             
         try:
-            status = device.status()
+            async with self._device_lock(device_id):
+                # Fetch under the lock so we don't reuse a connection closed while waiting
+                device = self.get_device_connection(device_id)
+                try:
+                    status = await self._run_blocking(device.status)
+                except asyncio.CancelledError:
+                    self._discard_device_state(device_id)
+                    raise
             if status and 'dps' in status:
+                self._record_status(device_id, status['dps'])
                 return {
                     "device_id": device_id,
-                    "name": self.devices[device_id].name,
+                    "name": self.names[self.id_index[device_id]],
                     "online": True,
                     "status": status['dps']
                 }
             else:
                 return {
                     "device_id": device_id,
-                    "name": self.devices[device_id].name,
+                    "name": self.names[self.id_index[device_id]],
                     "online": False,
                     "error": "Could not retrieve status"
                 }
         except Exception as e:
             return {
                 "device_id": device_id,
-                "name": self.devices[device_id].name,
+                "name": self.names[self.id_index[device_id]],
                 "online": False,
                 "error": str(e)
             }
             
-    async def control_device(self, device_id: str, command: str, value: Any = None) -> Dict[str, Any]:
+    async def _h_turn_on(self, device: tinytuya.Device, layout: Dict[str, Optional[str]],
+                         dps: Dict[str, Any], value: Any) -> Tuple[Any, Dict[str, Any]]:
+        """Switch the device on"""
+        power_dps = layout["power"]
+        result = await self._run_blocking(device.set_value, power_dps, True)
+        return result, {power_dps: True}
+        
+    async def _h_turn_off(self, device: tinytuya.Device, layout: Dict[str, Optional[str]],
+                          dps: Dict[str, Any], value: Any) -> Tuple[Any, Dict[str, Any]]:
+        """Switch the device off"""
+        power_dps = layout["power"]
+        result = await self._run_blocking(device.set_value, power_dps, False)
+        return result, {power_dps: False}
+        
+    async def _h_toggle(self, device: tinytuya.Device, layout: Dict[str, Optional[str]],
+                        dps: Dict[str, Any], value: Any) -> Tuple[Any, Dict[str, Any]]:
+        """Flip the power state"""
+        power_dps = layout["power"]
+        new_state = not dps.get(power_dps, False)
+        result = await self._run_blocking(device.set_value, power_dps, new_state)
+        return result, {power_dps: new_state}
+        
+    async def _h_set_brightness(self, device: tinytuya.Device, layout: Dict[str, Optional[str]],
+                                dps: Dict[str, Any], value: Any) -> Tuple[Any, Dict[str, Any]]:
+        """Set brightness (10-1000)"""
+        if value is None:
+            raise CommandError("Brightness value required")
+        brightness_dps = layout["brightness"]
+        if not brightness_dps:
+            raise CommandError("Device does not support brightness control")
+            
+        brightness_val = max(10, min(1000, int(value)))  # Scale to device range
+        result = await self._run_blocking(device.set_value, brightness_dps, brightness_val)
+        return result, {brightness_dps: brightness_val}
+        
+    async def _h_set_color(self, device: tinytuya.Device, layout: Dict[str, Optional[str]],
+                           dps: Dict[str, Any], value: Any) -> Tuple[Any, Dict[str, Any]]:
+        """Set an RGB color"""
+        try:
+            rgb = RGBValue.model_validate(value)
+        except ValidationError:
+            raise CommandError("Color RGB values required: {'r': 255, 'g': 0, 'b': 255}")
+            
+        # Determine device type based on DPS structure
+        if layout["color"] == '24':  # Merkury/Genii bulbs
+            color_hex = self.rgb_to_hsv_hex(rgb.r, rgb.g, rgb.b)
+            # Set color mode and color in a single message
+            changes = {'21': 'colour', '24': color_hex}
+            result = await self._run_blocking(device.set_multiple_values, changes)
+            return result, changes
+        elif layout["color"] == '5':  # Workbench lights  
+            color_hex = self.rgb_to_workbench_hex(rgb.r, rgb.g, rgb.b)
+            result = await self._run_blocking(device.set_value, '5', color_hex)
+            return result, {'5': color_hex}
+        raise CommandError("Device does not support color control")
+        
+    async def _h_set_magenta(self, device: tinytuya.Device, layout: Dict[str, Optional[str]],
+                             dps: Dict[str, Any], value: Any) -> Tuple[Any, Dict[str, Any]]:
+        """Set the app's magenta preset"""
+        # Use the exact values from the app
+        if layout["color"] == '24':  # Merkury/Genii bulbs
+            # Set color mode together with the Mercury magenta value (works for both brands)
+            changes = {'21': 'colour', '24': '013803e803e8'}
+            result = await self._run_blocking(device.set_multiple_values, changes)
+            return result, changes
+        elif layout["color"] == '5':  # Workbench lights - need to test this
+            result = await self._run_blocking(device.set_value, '5', 'ff00ff0000ffff')
+            return result, {'5': 'ff00ff0000ffff'}
+        raise CommandError("Device does not support color control")
+        
+    async def _h_set_dps(self, device: tinytuya.Device, layout: Dict[str, Optional[str]],
+                         dps: Dict[str, Any], value: Any) -> Tuple[Any, Dict[str, Any]]:
+        """Write a raw DPS value"""
+        try:
+            dps_value = DPSValue.model_validate(value)
+        except ValidationError:
+            raise CommandError("DPS number and value required in format: {'dp': number, 'value': data}")
+            
+        dp = str(dps_value.dp)
+        result = await self._run_blocking(device.set_value, dp, dps_value.value)
+        return result, {dp: dps_value.value}
+        
+    async def control_device(self, device_id: str, command: str, value: Any = None,
+                             verify: bool = False) -> Dict[str, Any]:
         """Control a device with various commands"""
+        # Reject unknown IDs before allocating a lock for them
+        if device_id not in self.id_index:
+            return {"error": f"Device {device_id} not found"}
+            
+        async with self._device_lock(device_id), self._command_slots():
+            try:
+                return await asyncio.wait_for(
+                    self._control_device(device_id, command, value, verify),
+                    timeout=_COMMAND_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                self._discard_device_state(device_id)
+                return {"device_id": device_id, "command": command, "error": "timeout", "success": False}
+            except asyncio.CancelledError:
+                # Cancelled by the caller (e.g. a batch deadline) mid-call
+                self._discard_device_state(device_id)
+                raise
+            
+    async def _control_device(self, device_id: str, command: str, value: Any = None,
+                              verify: bool = False) -> Dict[str, Any]:
+        """Execute a single device command (called with the concurrency semaphore held)"""
         device = self.get_device_connection(device_id)
         if not device:
             return {"error": f"Device {device_id} not found"}
             
-        try:
-            # First get current status to determine the correct DPS numbers
-            status = device.status()
-            if not status or 'dps' not in status:
-                return {"error": "Could not get device status"}
-            
-            dps = status['dps']
+        handler = self._handlers.get(command)
+        if handler is None:
+            return {"error": f"Unknown command: {command}"}
             
-            # Determine power DPS number (usually 1 or 20)
-            power_dps = None
-            if '1' in dps:
-                power_dps = '1'
-            elif '20' in dps:
-                power_dps = '20'
-            else:
+        try:
+            # Only read status when we don't yet know the DPS numbers this command needs
+            layout = self.dps_layout.get(device_id)
+            needed = _COMMAND_LAYOUT_KEYS.get(command)
+            if (layout is None or device_id not in self.last_dps
+                    or (needed and layout[needed] is None)):
+                status = await self._run_blocking(device.status)
+                if not status or 'dps' not in status:
+                    return {"error": "Could not get device status"}
+                self._record_status(device_id, status['dps'])
+                layout = self.dps_layout.get(device_id)
+                
+            if layout is None:
                 return {"error": "Could not determine power control DPS"}
+                
+            dps = self.last_dps[device_id]
             
-            result = None
-            
-            if command == "turn_on":
-                result = device.set_value(power_dps, True)
-            elif command == "turn_off":
-                result = device.set_value(power_dps, False)
-            elif command == "toggle":
-                current_state = dps.get(power_dps, False)
-                result = device.set_value(power_dps, not current_state)
-            elif command == "set_brightness":
-                if value is not None:
-                    # Try common brightness DPS numbers
-                    brightness_dps = None
-                    if '3' in dps:  # Common for some lights
-                        brightness_dps = '3'
-                    elif '22' in dps:  # Common for other lights
-                        brightness_dps = '22'
-                    elif '23' in dps:  # Another common one
-                        brightness_dps = '23'
-                    
-                    if brightness_dps:
-                        brightness_val = max(10, min(1000, int(value)))  # Scale to device range
-                        result = device.set_value(brightness_dps, brightness_val)
-                    else:
-                        return {"error": "Device does not support brightness control"}
-                else:
-                    return {"error": "Brightness value required"}
-            elif command == "set_color":
-                if value is not None and isinstance(value, dict) and "r" in value and "g" in value and "b" in value:
-                    r, g, b = int(value["r"]), int(value["g"]), int(value["b"])
-                    
-                    # Determine device type based on DPS structure
-                    if '24' in dps:  # Merkury/Genii bulbs
-                        color_hex = self.rgb_to_hsv_hex(r, g, b)
-                        # Set color mode first, then color
-                        device.set_value('21', 'colour')
-                        result = device.set_value('24', color_hex)
-                    elif '5' in dps:  # Workbench lights  
-                        color_hex = self.rgb_to_workbench_hex(r, g, b)
-                        result = device.set_value('5', color_hex)
-                    else:
-                        return {"error": "Device does not support color control"}
-                else:
-                    return {"error": "Color RGB values required: {'r': 255, 'g': 0, 'b': 255}"}
-            elif command == "set_magenta":
-                # Use the exact values from the app
-                if '24' in dps:  # Merkury/Genii bulbs
-                    # Set to color mode first
-                    device.set_value('21', 'colour')
-                    # Use Mercury magenta value (works for both brands)
-                    result = device.set_value('24', '013803e803e8')
-                elif '5' in dps:  # Workbench lights - need to test this
-                    result = device.set_value('5', 'ff00ff0000ffff')
-                else:
-                    return {"error": "Device does not support color control"}
-            elif command == "set_dps":
-                if value is not None and isinstance(value, dict) and "dp" in value and "value" in value:
-                    result = device.set_value(str(value["dp"]), value["value"])
+            try:
+                result, changes = await handler(device, layout, dps, value)
+            except CommandError as e:
+                return {"error": str(e)}
+                
+            if verify:
+                # Confirm the change with an extra status round-trip
+                new_status = await self._run_blocking(device.status)
+                success = bool(new_status and 'dps' in new_status)
+                new_dps = new_status.get('dps', {}) if new_status else {}
+                if success:
+                    self.last_dps[device_id] = dict(new_dps)
                 else:
-                    return {"error": "DPS number and value required in format: {'dp': number, 'value': data}"}
+                    self.last_dps.pop(device_id, None)
             else:
-                return {"error": f"Unknown command: {command}"}
-                
-            # Check if the command actually worked by getting new status
-            new_status = device.status()
-            success = new_status and 'dps' in new_status
+                # Assume the write landed; tinytuya returns an error dict on failure
+                success = result is not None and not (isinstance(result, dict) and "Error" in result)
+                new_dps = {**dps, **changes}
+                if success:
+                    self.last_dps[device_id] = new_dps
+                else:
+                    # State is uncertain; re-read it on the next command
+                    self.last_dps.pop(device_id, None)
                 
             return {
                 "device_id": device_id,
                 "command": command,
                 "result": result,
                 "old_status": dps,
-                "new_status": new_status.get('dps', {}) if new_status else {},
+                "new_status": new_dps,
                 "success": success
             }
             
         except Exception as e:
+            self.last_dps.pop(device_id, None)
             return {
                 "device_id": device_id,
                 "command": command,
@@ -301,87 +624,132 @@ device_manager = TuyaDeviceManager()
 # Create MCP server
 app = Server("tuya-mcp-server")
 
-@app.list_tools()
-async def handle_list_tools() -> list[Tool]:
-    """List available tools"""
-    return [
-        Tool(
-            name="discover_devices",
-            description="Scan the network to discover Tuya devices",
-            inputSchema={
-                "type": "object",
-                "properties": {},
-                "required": []
+# Indent only the human-facing listings; command results are consumed by the model
+_PRETTY = orjson.OPT_INDENT_2
+
+# Tool definitions are static, so build them once at import
+_TOOLS: list[Tool] = [
+    Tool(
+        name="discover_devices",
+        description="Scan the network to discover Tuya devices",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "timeout": {
+                    "type": "number",
+                    "description": "Scan duration in seconds (devices broadcast every 3-6 seconds)",
+                    "default": 6,
+                    "minimum": _MIN_SCAN_TIMEOUT,
+                    "maximum": _MAX_SCAN_TIMEOUT
+                }
             },
-        ),
-        Tool(
-            name="list_devices",
-            description="List all configured devices and their current status",
-            inputSchema={
-                "type": "object", 
-                "properties": {},
-                "required": []
+            "required": []
+        },
+    ),
+    Tool(
+        name="list_devices",
+        description="List all configured devices and their current status",
+        inputSchema={
+            "type": "object", 
+            "properties": {},
+            "required": []
+        },
+    ),
+    Tool(
+        name="get_device_status", 
+        description="Get current status of a specific device",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "device_id": {
+                    "type": "string",
+                    "description": "The device ID to check status for"
+                }
             },
-        ),
-        Tool(
-            name="get_device_status", 
-            description="Get current status of a specific device",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "device_id": {
-                        "type": "string",
-                        "description": "The device ID to check status for"
-                    }
+            "required": ["device_id"]
+        },
+    ),
+    Tool(
+        name="control_device",
+        description="Control a device (turn on/off, set brightness, set colors for Merkury/Genii bulbs)",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "device_id": {
+                    "type": "string", 
+                    "description": "The device ID to control"
                 },
-                "required": ["device_id"]
-            },
-        ),
-        Tool(
-            name="control_device",
-            description="Control a device (turn on/off, set brightness, set colors for Merkury/Genii bulbs)",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "device_id": {
-                        "type": "string", 
-                        "description": "The device ID to control"
-                    },
-                    "command": {
-                        "type": "string",
-                        "description": "Command to execute",
-                        "enum": ["turn_on", "turn_off", "toggle", "set_brightness", "set_color", "set_magenta", "set_dps"]
-                    },
-                    "value": {
-                        "description": "Value for the command (brightness level, RGB color object, or DPS object)"
-                    }
+                "command": {
+                    "type": "string",
+                    "description": "Command to execute",
+                    "enum": ["turn_on", "turn_off", "toggle", "set_brightness", "set_color", "set_magenta", "set_dps"]
+                },
+                "value": {
+                    "description": "Value for the command (brightness level, RGB color object, or DPS object)"
                 },
-                "required": ["device_id", "command"]
+                "verify": {
+                    "type": "boolean",
+                    "description": "Re-read device status after the command to confirm it (slower)",
+                    "default": False
+                }
             },
-        ),
-        Tool(
-            name="control_multiple_devices",
-            description="Control multiple devices at once",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "operations": {
-                        "type": "array",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "device_id": {"type": "string"},
-                                "command": {"type": "string"}, 
-                                "value": {"type": ["number", "object", "null"]}
-                            },
-                            "required": ["device_id", "command"]
+            "required": ["device_id", "command"]
+        },
+    ),
+    Tool(
+        name="control_multiple_devices",
+        description="Control multiple devices at once",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "operations": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "device_id": {"type": "string"},
+                            "command": {"type": "string"}, 
+                            "value": {"type": ["number", "object", "null"]},
+                            "verify": {"type": "boolean"}
                         },
-                        "description": "Array of device operations to perform"
-                    }
-                },
-                "required": ["operations"]
+                        "required": ["device_id", "command"]
+                    },
+                    "description": "Array of device operations to perform"
+                }
             },
-        ),
+            "required": ["operations"]
+        },
+    ),
+]
+
+@app.list_tools()
+async def handle_list_tools() -> list[Tool]:
+    """List available tools"""
+    return _TOOLS
+
+async def _gather_within(coros: list, timeout: float) -> list:
+    """Run coroutines concurrently for at most timeout seconds
+    
+    Returns one entry per coroutine, in order: its result, the exception it
+    raised, or an asyncio.TimeoutError if it was still running and got cancelled.
+    """
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    if not tasks:
+        return []
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+    finally:
+        # Cancel whatever is unfinished, including when we are cancelled ourselves,
+        # and let those tasks run their cleanup before we return or re-raise
+        unfinished = [task for task in tasks if not task.done()]
+        for task in unfinished:
+            task.cancel()
+        if unfinished:
+            await asyncio.wait(unfinished)
+    return [
+        asyncio.TimeoutError() if task in pending
+        else task.exception() or task.result()
+        for task in tasks
     ]
 
 @app.call_tool()
@@ -389,36 +757,55 @@ async def handle_call_tool(name: str, arguments: dict) -> list[TextContent]:
     """Handle tool calls"""
     
     if name == "discover_devices":
-        devices = await device_manager.discover_devices()
+        try:
+            timeout = float(arguments.get("timeout", 6))
+        except (TypeError, ValueError):
+            timeout = math.nan
+        if not math.isfinite(timeout):
+            return [TextContent(type="text", text="Timeout must be a number of seconds")]
+        devices = await device_manager.discover_devices(timeout)
         return [
             TextContent(
                 type="text", 
-                text=f"Found {len(devices)} devices on network:\n{json.dumps(devices, indent=2)}"
+                text=f"Found {len(devices)} devices on network:\n{orjson.dumps(devices, option=_PRETTY).decode()}"
             )
         ]
         
     elif name == "list_devices":
-        if not device_manager.devices:
+        if not device_manager.ids:
             return [TextContent(
                 type="text",
                 text="No devices configured. Run discover_devices or set up devices.json file."
             )]
             
+        # Query all devices concurrently so one slow device doesn't serialize the rest
+        # Devices still pending at the deadline are reported as timed out
+        device_ids = list(device_manager.ids)
+        statuses = await _gather_within(
+            [device_manager.get_device_status(device_id) for device_id in device_ids],
+            timeout=_LIST_DEVICES_TIMEOUT
+        )
+            
         device_list = []
-        for device_id, config in device_manager.devices.items():
-            status = await device_manager.get_device_status(device_id)
+        for device_id, name, ip, device_type, status in zip(
+            device_ids, device_manager.names, device_manager.ips, device_manager.types, statuses
+        ):
+            if isinstance(status, asyncio.TimeoutError):
+                status = {"device_id": device_id, "online": False, "error": "timeout"}
+            elif isinstance(status, Exception):
+                status = {"device_id": device_id, "online": False, "error": str(status)}
             device_list.append({
                 "device_id": device_id,
-                "name": config.name,
-                "ip": config.ip,
-                "type": config.device_type,
+                "name": name,
+                "ip": ip,
+                "type": device_type,
                 "status": status
             })
             
         return [
             TextContent(
                 type="text",
-                text=f"Found {len(device_list)} configured devices:\n{json.dumps(device_list, indent=2)}"
+                text=f"Found {len(device_list)} configured devices:\n{orjson.dumps(device_list, option=_PRETTY).decode()}"
             )
         ]
         
@@ -428,36 +815,48 @@ async def handle_call_tool(name: str, arguments: dict) -> list[TextContent]:
             return [TextContent(type="text", text="Device ID is required")]
             
         status = await device_manager.get_device_status(device_id)
-        return [TextContent(type="text", text=json.dumps(status, indent=2))]
+        return [TextContent(type="text", text=orjson.dumps(status).decode())]
         
     elif name == "control_device":
         device_id = arguments.get("device_id")
         command = arguments.get("command")
         value = arguments.get("value")
+        verify = bool(arguments.get("verify", False))
         
         if not device_id or not command:
             return [TextContent(type="text", text="Device ID and command are required")]
             
-        result = await device_manager.control_device(device_id, command, value)
-        return [TextContent(type="text", text=json.dumps(result, indent=2))]
+        result = await device_manager.control_device(device_id, command, value, verify)
+        return [TextContent(type="text", text=orjson.dumps(result).decode())]
         
     elif name == "control_multiple_devices":
-        operations = arguments.get("operations", [])
+        operations = [
+            op for op in arguments.get("operations", [])
+            if op.get("device_id") and op.get("command")
+        ]
+        # Bound the whole batch so one scene change can't stall the MCP connection;
+        # operations that finished in time are still reported
+        outcomes = await _gather_within(
+            [
+                device_manager.control_device(
+                    op["device_id"], op["command"], op.get("value"), bool(op.get("verify", False))
+                )
+                for op in operations
+            ],
+            timeout=_BATCH_TIMEOUT
+        )
         results = []
-        
-        for op in operations:
-            device_id = op.get("device_id")
-            command = op.get("command")
-            value = op.get("value")
-            
-            if device_id and command:
-                result = await device_manager.control_device(device_id, command, value)
-                results.append(result)
+        for op, outcome in zip(operations, outcomes):
+            if isinstance(outcome, asyncio.TimeoutError):
+                outcome = {"device_id": op["device_id"], "error": "timeout", "success": False}
+            elif isinstance(outcome, Exception):
+                outcome = {"device_id": op["device_id"], "error": str(outcome), "success": False}
+            results.append(outcome)
                 
         return [
             TextContent(
                 type="text",
-                text=f"Executed {len(results)} operations:\n{json.dumps(results, indent=2)}"
+                text=f"Executed {len(results)} operations:\n{orjson.dumps(results).decode()}"
             )
         ]
         
@@ -466,25 +865,51 @@ async def handle_call_tool(name: str, arguments: dict) -> list[TextContent]:
 
 async def main():
     """Main server entry point"""
-    # Load device configurations
-    await device_manager.load_devices()
+    # Load device configurations; connection warm-up is opt-in since it holds
+    # a socket to every device
+    await device_manager.load_devices(
+        warm=os.environ.get("TUYA_MCP_WARM_CONNECTIONS", "") == "1"
+    )
     
     # Run the server using stdin/stdout
     from mcp.server.stdio import stdio_server
     
-    async with stdio_server() as (read_stream, write_stream):
-        await app.run(
-            read_stream,
-            write_stream,
-            InitializationOptions(
-                server_name="tuya-mcp-server",
-                server_version="0.1.0",
-                capabilities=app.get_capabilities(
-                    notification_options=NotificationOptions(),
-                    experimental_capabilities={},
+    # Close persistent sockets soon after use: devices drop idle connections after
+    # ~30s anyway, and many accept only one connection, locking out the vendor app
+    try:
+        idle_timeout = float(os.environ.get("TUYA_MCP_IDLE_TIMEOUT", "30"))
+    except ValueError:
+        logger.warning("Invalid TUYA_MCP_IDLE_TIMEOUT; using 30 seconds")
+        idle_timeout = 30
+    reaper = asyncio.create_task(device_manager.reap_idle_connections(idle_timeout=idle_timeout))
+    
+    try:
+        async with stdio_server() as (read_stream, write_stream):
+            await app.run(
+                read_stream,
+                write_stream,
+                InitializationOptions(
+                    server_name="tuya-mcp-server",
+                    server_version="0.1.0",
+                    capabilities=app.get_capabilities(
+                        notification_options=NotificationOptions(),
+                        experimental_capabilities={},
+                    ),
                 ),
-            ),
-        )
+            )
+    finally:
+        reaper.cancel()
+        await device_manager.close()
 
-if __name__ == "__main__":
+def cli_main():
+    """Run the server, using uvloop's faster event loop when it is installed"""
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())
+
+if __name__ == "__main__":
+    cli_main()
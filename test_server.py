@@ -28,17 +28,17 @@ async def test_device_manager():
     print("\n📂 Test 1: Loading device configuration...")
     await manager.load_devices()
     
-    if manager.devices:
-        print(f"✅ Found {len(manager.devices)} configured devices:")
-        for device_id, config in manager.devices.items():
-            print(f"   - {config.name} ({device_id}) at {config.ip}")
+    if manager.ids:
+        print(f"✅ Found {len(manager.ids)} configured devices:")
+        for device_id, name, ip in zip(manager.ids, manager.names, manager.ips):
+            print(f"   - {name} ({device_id}) at {ip}")
     else:
         print("⚠️  No devices found in configuration.")
         print("   Run 'python -m tinytuya wizard' to set up devices.json")
         
     # Test 2: Device discovery (optional, can be slow)
     print("\n🔍 Test 2: Network device discovery (optional)...")
-    print("   This may take 20+ seconds. Press Ctrl+C to skip.")
+    print("   This may take several seconds. Press Ctrl+C to skip.")
     
     try:
         discovered = await manager.discover_devices()
@@ -57,19 +57,19 @@ async def test_device_manager():
         print(f"❌ Discovery failed: {e}")
         
     # Test 3: Device status check (if we have devices)
-    if manager.devices:
+    if manager.ids:
         print(f"\n📊 Test 3: Checking status of configured devices...")
-        for device_id, config in list(manager.devices.items())[:2]:  # Test first 2 devices
-            print(f"   Checking {config.name}...")
+        for device_id, name in list(zip(manager.ids, manager.names))[:2]:  # Test first 2 devices
+            print(f"   Checking {name}...")
             status = await manager.get_device_status(device_id)
             
             if status.get('online'):
-                print(f"   ✅ {config.name} is online")
+                print(f"   ✅ {name} is online")
                 if 'status' in status:
                     dps = status['status']
                     print(f"      Status: {dps}")
             else:
-                print(f"   ❌ {config.name} is offline or unreachable")
+                print(f"   ❌ {name} is offline or unreachable")
                 if 'error' in status:
                     print(f"      Error: {status['error']}")
     
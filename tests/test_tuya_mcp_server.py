@@ -0,0 +1,419 @@
+"""
+Tests for the Tuya MCP server using stubbed tinytuya devices
+
+The stubs sleep to simulate network round-trips and record whether two
+threads ever use the same device (socket) at once.
+"""
+
+import asyncio
+import sys
+import threading
+import time
+from pathlib import Path
+
+import orjson
+import pytest
+from pydantic import ValidationError
+
+# Add src directory to Python path
+src_path = Path(__file__).parent.parent / "src"
+sys.path.insert(0, str(src_path))
+
+import tuya_mcp_server
+from tuya_mcp_server import DeviceConfig, TuyaDeviceManager
+
+
+class StubDevice:
+    """Stand-in for tinytuya.Device with a configurable round-trip delay"""
+
+    delays = {}  # device_id -> seconds per call
+    overlaps = []  # device_ids that were used by two threads at once
+
+    def __init__(self, device_id, ip=None, local_key=None, version=3.3):
+        self.device_id = device_id
+        self.dps = {'1': False, '3': 500}
+        self.calls = []  # (method, *args) for each round-trip
+        self.closed = False
+        self._active = 0
+        self._guard = threading.Lock()
+
+    def set_socketTimeout(self, timeout):
+        pass
+
+    def set_socketPersistent(self, persistent):
+        pass
+
+    def set_socketRetryLimit(self, limit):
+        pass
+
+    def _round_trip(self):
+        with self._guard:
+            self._active += 1
+            if self._active > 1:
+                StubDevice.overlaps.append(self.device_id)
+        try:
+            time.sleep(StubDevice.delays.get(self.device_id, 0))
+        finally:
+            with self._guard:
+                self._active -= 1
+
+    def status(self):
+        self.calls.append(("status",))
+        self._round_trip()
+        return {'dps': dict(self.dps)}
+
+    def set_value(self, dp, value):
+        self.calls.append(("set_value", dp, value))
+        self._round_trip()
+        self.dps[str(dp)] = value
+        return {'dps': {str(dp): value}}
+
+    def set_multiple_values(self, data):
+        self.calls.append(("set_multiple_values", dict(data)))
+        self._round_trip()
+        self.dps.update(data)
+        return {'dps': dict(data)}
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    """A device manager with stubbed tinytuya devices, installed as the server's manager"""
+    StubDevice.delays = {}
+    StubDevice.overlaps = []
+    for cls in ("Device", "BulbDevice", "OutletDevice"):
+        monkeypatch.setattr(tuya_mcp_server.tinytuya, cls, StubDevice)
+
+    manager = TuyaDeviceManager()
+    for i in range(4):
+        manager._add_device(DeviceConfig(
+            device_id=f"d{i}", name=f"Device {i}", ip=f"10.0.0.{i}", local_key="k"
+        ))
+    monkeypatch.setattr(tuya_mcp_server, "device_manager", manager)
+    yield manager
+    manager._executor.shutdown(wait=True)
+
+
+def _payload(contents):
+    """Decode the JSON part of a tool response"""
+    text = contents[0].text
+    return orjson.loads(text[text.index("\n") + 1:] if "\n" in text else text)
+
+
+@pytest.mark.asyncio
+async def test_list_devices_keeps_statuses_that_finished(manager, monkeypatch):
+    monkeypatch.setattr(tuya_mcp_server, "_LIST_DEVICES_TIMEOUT", 0.3)
+    StubDevice.delays = {"d3": 1.0}
+
+    device_list = _payload(await tuya_mcp_server.handle_call_tool("list_devices", {}))
+
+    by_id = {d["device_id"]: d["status"] for d in device_list}
+    assert all(by_id[f"d{i}"]["online"] for i in range(3))
+    assert by_id["d3"] == {"device_id": "d3", "online": False, "error": "timeout"}
+    # The slow device's socket is dropped, so the next request can't share it
+    assert "d3" not in manager.device_connections
+
+    await manager.get_device_status("d3")
+    assert StubDevice.overlaps == []
+
+
+@pytest.mark.asyncio
+async def test_reaper_waits_for_in_flight_request(manager):
+    StubDevice.delays = {"d0": 0.5}
+    device = manager.get_device_connection("d0")
+    status_task = asyncio.create_task(manager.get_device_status("d0"))
+    await asyncio.sleep(0.1)
+
+    # With a zero idle timeout the reaper wants to close d0 straight away
+    reaper = asyncio.create_task(manager.reap_idle_connections(idle_timeout=0, interval=0.05))
+    await asyncio.sleep(0.2)
+    assert not device.closed  # still in use by the status request
+
+    await status_task
+    await asyncio.sleep(0.2)
+    reaper.cancel()
+    assert device.closed
+
+
+@pytest.mark.asyncio
+async def test_partial_status_does_not_pin_dps_layout(manager):
+    device = manager.get_device_connection("d0")
+    device.dps = {}
+    await manager.get_device_status("d0")
+    assert "d0" not in manager.dps_layout
+
+    # Once the device reports its power DPS, commands work
+    device.dps = {'1': False}
+    result = await manager.control_device("d0", "turn_on")
+    assert result["success"]
+    assert manager.dps_layout["d0"]["brightness"] is None
+
+    # A brightness DPS that appears later is picked up when it's needed
+    device.dps['3'] = 500
+    result = await manager.control_device("d0", "set_brightness", 800)
+    assert result["success"]
+    assert manager.dps_layout["d0"]["brightness"] == '3'
+    assert device.dps['3'] == 800
+
+
+@pytest.mark.asyncio
+async def test_load_devices_skips_invalid_entries(tmp_path):
+    config_file = tmp_path / "devices.json"
+    config_file.write_bytes(orjson.dumps([
+        {"id": "a", "ip": "10.0.0.1", "key": "k", "version": "3.4a"},
+        {"id": "b", "ip": "10.0.0.2", "key": "k", "version": ""},
+        {"id": "c", "ip": "10.0.0.3"},
+        {"id": "d", "ip": "10.0.0.4", "key": "k", "version": 3.5},
+    ]))
+    manager = TuyaDeviceManager()
+    manager.config_file = config_file
+
+    await manager.load_devices()
+
+    assert manager.ids == ["b", "d"]
+    assert manager.versions == [3.3, 3.5]
+    config = DeviceConfig(device_id="b", name="b", ip="x", local_key="k", version="")
+    assert (config.version, config.version_f) == ("3.3", 3.3)
+    manager._executor.shutdown(wait=True)
+
+
+@pytest.mark.asyncio
+async def test_unknown_device_gets_no_lock(manager):
+    result = await manager.control_device("nope", "turn_on")
+    assert result == {"error": "Device nope not found"}
+    assert "nope" not in manager._device_locks
+
+
+@pytest.mark.asyncio
+async def test_warm_up_is_opt_in(manager, tmp_path):
+    config_file = tmp_path / "devices.json"
+    config_file.write_bytes(orjson.dumps([{"id": "d0", "ip": "10.0.0.0", "key": "k"}]))
+    manager.config_file = config_file
+
+    await manager.load_devices()
+    assert manager._warm_task is None
+
+    manager._loaded = False
+    await manager.load_devices(warm=True)
+    await manager._warm_task
+    assert manager.dps_layout["d0"]["power"] == '1'
+
+
+@pytest.mark.asyncio
+async def test_batch_timeout_keeps_finished_results(manager, monkeypatch):
+    monkeypatch.setattr(tuya_mcp_server, "_BATCH_TIMEOUT", 0.5)
+    StubDevice.delays = {"d3": 0.4}  # status + set_value = 0.8s, past the deadline
+    operations = [{"device_id": f"d{i}", "command": "turn_on"} for i in range(4)]
+
+    results = _payload(await tuya_mcp_server.handle_call_tool(
+        "control_multiple_devices", {"operations": operations}
+    ))
+
+    assert [r["success"] for r in results] == [True, True, True, False]
+    assert results[3] == {"device_id": "d3", "error": "timeout", "success": False}
+    # The cancelled op's socket and cached state are dropped...
+    assert "d3" not in manager.device_connections
+    assert "d3" not in manager.last_dps
+
+    # ...so a follow-up command opens a fresh connection instead of sharing it
+    result = await manager.control_device("d3", "turn_off")
+    assert result["success"]
+    assert StubDevice.overlaps == []
+
+
+@pytest.mark.asyncio
+async def test_status_read_after_timed_out_command_uses_fresh_connection(manager, monkeypatch):
+    monkeypatch.setattr(tuya_mcp_server, "_COMMAND_TIMEOUT", 0.2)
+    StubDevice.delays = {"d0": 0.5}
+    stale = manager.get_device_connection("d0")
+
+    command = asyncio.create_task(manager.control_device("d0", "turn_on"))
+    await asyncio.sleep(0.05)
+    # Queued behind the command on the device lock
+    status = await manager.get_device_status("d0")
+    result = await command
+
+    assert result["error"] == "timeout"
+    assert status["online"]
+    assert stale.closed
+    assert manager.device_connections["d0"] is not stale
+    assert StubDevice.overlaps == []
+
+
+@pytest.mark.asyncio
+async def test_cancelled_batch_cancels_its_operations(manager):
+    StubDevice.delays = {f"d{i}": 0.3 for i in range(3)}
+    devices = [manager.get_device_connection(f"d{i}") for i in range(3)]
+    operations = [{"device_id": f"d{i}", "command": "turn_on"} for i in range(3)]
+
+    call = asyncio.create_task(tuya_mcp_server.handle_call_tool(
+        "control_multiple_devices", {"operations": operations}
+    ))
+    await asyncio.sleep(0.1)
+    call.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await call
+
+    await asyncio.sleep(0.5)
+    assert [d.dps['1'] for d in devices] == [False, False, False]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("timeout, scanned", [(6, 6), (0, 1), (1e9, 30), ("12", 12)])
+async def test_discover_timeout_is_clamped(manager, monkeypatch, timeout, scanned):
+    calls = []
+    monkeypatch.setattr(tuya_mcp_server.tinytuya, "deviceScan",
+                        lambda verbose, maxretry: calls.append(maxretry) or {})
+
+    await tuya_mcp_server.handle_call_tool("discover_devices", {"timeout": timeout})
+
+    assert calls == [scanned]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("timeout", ["abc", None, "nan", "inf"])
+async def test_discover_rejects_bad_timeout(manager, monkeypatch, timeout):
+    monkeypatch.setattr(tuya_mcp_server.tinytuya, "deviceScan",
+                        lambda verbose, maxretry: pytest.fail("scan should not run"))
+
+    contents = await tuya_mcp_server.handle_call_tool("discover_devices", {"timeout": timeout})
+
+    assert contents[0].text == "Timeout must be a number of seconds"
+
+
+@pytest.mark.parametrize("rgb, expected", [
+    ((255, 0, 255), "034103e803e8"),  # magenta
+    ((255, 0, 0), "000003e803e8"),
+    ((0, 255, 0), "014d03e803e8"),
+    ((0, 0, 255), "029a03e803e8"),
+    ((255, 128, 0), "005303e803e8"),
+    ((255, 255, 255), "0000000003e8"),
+    ((0, 0, 0), "000000000000"),
+])
+def test_rgb_to_hsv_hex(rgb, expected):
+    assert TuyaDeviceManager.rgb_to_hsv_hex(*rgb) == expected
+
+
+def test_rgb_to_hsv_hex_matches_colorsys_within_one():
+    import colorsys
+    import random
+
+    rng = random.Random(0)
+    for _ in range(20000):
+        r, g, b = (rng.randrange(256) for _ in range(3))
+        h, s, v = colorsys.rgb_to_hsv(r / 255, g / 255, b / 255)
+        hex_value = TuyaDeviceManager.rgb_to_hsv_hex(r, g, b)
+        got = [int(hex_value[i:i + 4], 16) for i in (0, 4, 8)]
+        want = [int(h * 1000), int(s * 1000), int(v * 1000)]
+        assert all(abs(x - y) <= 1 for x, y in zip(got, want)), (r, g, b)
+
+
+@pytest.mark.asyncio
+async def test_set_color_on_dp24_bulb_sends_one_message(manager):
+    device = manager.get_device_connection("d0")
+    device.dps = {'20': False, '21': 'white', '22': 500, '24': '000003e803e8'}
+
+    result = await manager.control_device("d0", "set_color", {"r": 255, "g": 0, "b": 255})
+
+    assert result["success"]
+    assert device.calls == [
+        ("status",),
+        ("set_multiple_values", {'21': 'colour', '24': '034103e803e8'}),
+    ]
+    assert result["new_status"]['24'] == '034103e803e8'
+
+
+@pytest.mark.asyncio
+async def test_set_color_on_workbench_light_uses_rgb_hex(manager):
+    device = manager.get_device_connection("d0")
+    device.dps = {'1': True, '5': 'ff000000000000'}
+
+    result = await manager.control_device("d0", "set_color", {"r": 255, "g": 0, "b": 255})
+
+    assert result["success"]
+    assert device.calls[-1] == ("set_value", '5', 'ffff00ff00ffff')
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("value", [
+    {"r": 300, "g": 0, "b": 0},
+    {"r": -1, "g": 0, "b": 0},
+    {"r": 255, "g": 0},
+    "magenta",
+    None,
+])
+async def test_set_color_rejects_bad_rgb(manager, value):
+    device = manager.get_device_connection("d0")
+    device.dps = {'1': True, '5': 'ff000000000000'}
+
+    result = await manager.control_device("d0", "set_color", value)
+
+    assert result == {"error": "Color RGB values required: {'r': 255, 'g': 0, 'b': 255}"}
+    assert not any(call[0] != "status" for call in device.calls)
+
+
+@pytest.mark.asyncio
+async def test_set_dps_writes_raw_value(manager):
+    device = manager.get_device_connection("d0")
+
+    result = await manager.control_device("d0", "set_dps", {"dp": "7", "value": True})
+
+    assert result["success"]
+    assert device.calls[-1] == ("set_value", '7', True)
+    assert result["new_status"]['7'] is True
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("value", [{"dp": "x", "value": 1}, {"dp": 7}, [7, True], None])
+async def test_set_dps_rejects_bad_value(manager, value):
+    result = await manager.control_device("d0", "set_dps", value)
+
+    assert result == {
+        "error": "DPS number and value required in format: {'dp': number, 'value': data}"
+    }
+
+
+@pytest.mark.asyncio
+async def test_toggle_uses_cached_state(manager):
+    device = manager.get_device_connection("d0")
+    await manager.get_device_status("d0")
+    device.calls.clear()
+
+    first = await manager.control_device("d0", "toggle")
+    second = await manager.control_device("d0", "toggle")
+
+    # No status reads: the power state comes from last_dps, updated by each write
+    assert device.calls == [("set_value", '1', True), ("set_value", '1', False)]
+    assert (first["old_status"]['1'], first["new_status"]['1']) == (False, True)
+    assert manager.last_dps["d0"]['1'] is False
+    assert second["success"]
+
+
+@pytest.mark.asyncio
+async def test_verify_rereads_status(manager):
+    device = manager.get_device_connection("d0")
+    await manager.get_device_status("d0")
+    device.calls.clear()
+
+    # Without verify the result is derived locally
+    await manager.control_device("d0", "turn_on")
+    assert device.calls == [("set_value", '1', True)]
+
+    # With verify the device is read back, so an external change shows up
+    device.calls.clear()
+    device.dps['3'] = 42
+    result = await manager.control_device("d0", "turn_off", verify=True)
+
+    assert device.calls == [("set_value", '1', False), ("status",)]
+    assert result["new_status"] == {'1': False, '3': 42}
+    assert manager.last_dps["d0"] == {'1': False, '3': 42}
+
+
+def test_device_config_version_f_is_derived():
+    config = DeviceConfig(device_id="a", name="a", ip="x", local_key="k", version="3.4")
+    assert config.version_f == 3.4
+
+    with pytest.raises(ValidationError):
+        DeviceConfig(device_id="a", name="a", ip="x", local_key="k", version_f=3.5)